@@ -1 +1,2 @@
-__all__ = ["api", "config", "scanner"]
+__all__ = ["api", "config", "logs", "profiling", "scanner", "scheduler",
+           "synthetic"]
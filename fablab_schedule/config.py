@@ -20,6 +20,15 @@ example_config_filename = "fablab_schedule.cfg.example"
 _config = None
 
 
+# Keys of the configuration dictionary by section of the configuration file.
+section_keys = {
+    "api": ["username", "password", "base_url"],
+    "table": ["n_machines", "n_slots", "row_offsets", "column_offsets",
+              "slot_size"],
+    "camera": ["vertical_flip", "horizontal_flip"],
+}
+
+
 def get_default_config_file_path():
     return resource_filename("fablab_schedule",
                              "conf/" + example_config_filename)
@@ -55,13 +64,15 @@ def make_config_dict_from_parser(parser):
     return config
 
 
+def get_config_file_paths():
+    """Paths of the default and global configuration files, in read order."""
+    return [get_default_config_file_path(), get_global_config_file_path()]
+
+
 def get():
     global _config
     if _config is None:
-        parser = configparser.ConfigParser()
-        parser.read_file(open(get_default_config_file_path()))
-        parser.read(get_global_config_file_path())
-        _config = make_config_dict_from_parser(parser)
+        _config = from_files(get_config_file_paths())
     return _config
 
 
@@ -69,3 +80,68 @@ def from_file(filepath):
     parser = configparser.ConfigParser()
     parser.read_file(open(filepath))
     return make_config_dict_from_parser(parser)
+
+
+def from_files(filepaths):
+    """Read the configuration from a sequence of files.
+
+    The first file is required, the following ones are optional and override
+    the values of the previous ones.
+    """
+    parser = configparser.ConfigParser()
+    parser.read_file(open(filepaths[0]))
+    parser.read(filepaths[1:])
+    return make_config_dict_from_parser(parser)
+
+
+def changed_sections(old_config, new_config):
+    """Find the sections whose values differ between two configurations.
+
+    Returns
+    -------
+    set of string
+        Names of the changed sections, among the keys of `section_keys`.
+    """
+    return set(section for section, keys in section_keys.items()
+               if any(old_config.get(key) != new_config.get(key)
+                      for key in keys))
+
+
+class ConfigWatcher:
+    """Watch configuration files for modifications.
+
+    The modification time and the size of the files are polled, which is
+    cheap enough to be done on every iteration of the daemon.
+
+    Parameters
+    ----------
+    filepaths: sequence of string
+        Paths of the watched files, which may not exist.
+    """
+
+    def __init__(self, filepaths):
+        self.filepaths = filepaths
+        self.stamps = self.stat()
+
+    def stat(self):
+        stamps = []
+        for filepath in self.filepaths:
+            try:
+                info = os.stat(filepath)
+            except (OSError, IOError):
+                stamps.append(None)
+            else:
+                stamps.append((info.st_mtime, info.st_size))
+        return stamps
+
+    def poll(self):
+        """Return `True` if a file changed since the last poll."""
+        stamps = self.stat()
+        if stamps == self.stamps:
+            return False
+        self.stamps = stamps
+        return True
+
+    def read(self):
+        """Read the configuration from the watched files."""
+        return from_files(self.filepaths)
@@ -1,18 +1,23 @@
 import argparse
+import atexit
+import contextlib
 import errno
 import json
 import logging
-from logging.handlers import RotatingFileHandler
 import os
 import os.path
 from pkg_resources import resource_filename
 import random
+import signal
 import subprocess
 import time
 
 import requests
 
-from fablab_schedule import api, config, scanner
+import cv2
+import numpy as np
+
+from fablab_schedule import api, config, logs, profiling, scanner, scheduler
 
 
 def get_log_file_path():
@@ -23,28 +28,47 @@ def get_log_file_path():
 
 
 def build_logger():
+    """Build the daemon logger.
+
+    The records are written asynchronously by a background thread, by batches,
+    to the standard error and to the log file.
+    """
     log_path = get_log_file_path()
 
     logger = logging.getLogger("schedule")
     logger.setLevel(logging.DEBUG)
     format = '%(asctime)s - %(levelname)s - %(name)s - %(message)s'
     logging.basicConfig(format=format)
+    formatter = logging.Formatter(format)
 
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+    handlers = [stream_handler]
+
+    error = None
     try:
-        file_handler = RotatingFileHandler(log_path, maxBytes=5e6,
-                                           backupCount=1)
+        file_handler = logs.BatchRotatingFileHandler(log_path, maxBytes=5e6,
+                                                     backupCount=1)
     except (OSError, IOError) as e:
         # OSError for Python 3
         # IOErro for Python 2
         if e.errno == errno.EACCES:
-            logger.warning("cannot open log file %s: %s", log_path, e.strerror)
+            error = e
         else:
             raise(e)
     else:
         file_handler.setLevel(logging.DEBUG)
-        formatter = logging.Formatter(format)
         file_handler.setFormatter(formatter)
-        logger.addHandler(file_handler)
+        handlers.append(file_handler)
+
+    writer = logs.BatchWriter(handlers, flush_interval=30.0)
+    logger.addHandler(writer.queue_handler)
+    logger.propagate = False
+    writer.start()
+    atexit.register(writer.stop)
+
+    if error is not None:
+        logger.warning("cannot open log file %s: %s", log_path, error.strerror)
 
     return logger
 
@@ -54,38 +78,213 @@ logger = build_logger()
 _config = {}
 
 
-def grab(image_path):
-    """Grab an image with the camera.
+class FrameSource:
+    """Capture the images of the wall.
+
+    Once the wall is registered, the capture can be restricted to a region of
+    interest around it: the camera then only reads out that region of the
+    sensor, giving smaller images at the same or a higher resolution.
 
     Parameters
     ----------
-    image_path: string
-        File path where to store the image.
-
-    Raises
-    ------
-    RuntimeError if the subprocess call fails.
+    vertical_flip, horizontal_flip: bool
+        Flip the captured images.
+    use_test_image: bool
+        Use the bundled test image instead of the camera. The region of
+        interest is then cropped from the test image.
+    use_roi: bool
+        Restrict the capture to the region of interest when known.
+    roi_margin: float
+        Margin added around the region of interest, relative to its size.
+    roi_scale: float
+        Resolution of the region of interest relative to the full frame.
     """
-    tmp_image_path = '/tmp/fablab_schedule_image.tmp'
-    args = ['/opt/vc/bin/raspistill',
-            '--output', tmp_image_path,
-            '--encoding', 'png',
-            '--timeout', '1',
-            '--exposure', 'auto',
-            '--width', '648',
-            '--height', '486',
-            ]
-    if _config['vertical_flip']:
-        args += ['--vflip']
-    if _config['horizontal_flip']:
-        args += ['--hflip']
-    try:
-        subprocess.check_output(args, stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError as e:
-        raise RuntimeError(e.output.decode("utf-8"))
-    os.rename(tmp_image_path, image_path)
 
-    return True
+    capture_path = "/tmp/capture.png"
+    frame_width = 648
+    frame_height = 486
+
+    def __init__(self, vertical_flip=False, horizontal_flip=False,
+                 use_test_image=False, use_roi=False, roi_margin=0.1,
+                 roi_scale=1.0):
+        self.vertical_flip = vertical_flip
+        self.horizontal_flip = horizontal_flip
+        self.use_test_image = use_test_image
+        self.use_roi = use_roi
+        self.roi_margin = roi_margin
+        self.test_image = None
+        if use_test_image:
+            self.test_image = scanner.read_image_grayscale(
+                get_test_image_path())
+            self.frame_shape = self.test_image.shape[:2]
+            # A crop cannot increase the resolution.
+            self.roi_scale = 1.0
+        else:
+            self.frame_shape = (self.frame_height, self.frame_width)
+            self.roi_scale = roi_scale
+        # (x, y, width, height) in the pixels of the full frame.
+        self.region = None
+
+    def frame_to_image(self):
+        """Transformation from the full frame to the captured image.
+
+        Returns
+        -------
+        ndarray
+            The (3, 3) transformation matrix, or `None` for the full frame.
+        """
+        if self.region is None:
+            return None
+        x, y, _, _ = self.region
+        scale = self.roi_scale
+        return np.array([[scale, 0, -scale * x],
+                         [0, scale, -scale * y],
+                         [0, 0, 1]])
+
+    def update_region(self, transformation, reference_shape):
+        """Restrict the capture to the reference seen in the full frame.
+
+        The whole reference is kept, and not only the table, since its
+        surroundings hold the features for the registration.
+
+        Parameters
+        ----------
+        transformation: ndarray
+            (3, 3) transformation from the reference to the full frame, or
+            `None` to capture the full frame.
+        reference_shape: tuple of int
+            (M, N) shape of the reference image.
+        """
+        region = None
+        if self.use_roi and transformation is not None:
+            region = self.find_region(transformation, reference_shape,
+                                      self.roi_margin)
+        if region is not None and self.region is not None:
+            # Keep the current region while it holds the reference with at
+            # least half the margin and is not much larger than needed, to
+            # avoid reconfiguring the capture at every small variation.
+            inner = self.find_region(transformation, reference_shape,
+                                     self.roi_margin / 2)
+            x_old, y_old, width_old, height_old = self.region
+            inside = False
+            if inner is not None:
+                x, y, width, height = inner
+                inside = x_old <= x and y_old <= y \
+                    and x + width <= x_old + width_old \
+                    and y + height <= y_old + height_old
+            oversized = width_old * height_old > 1.25 * region[2] * region[3]
+            if inside and not oversized:
+                return
+        if region != self.region:
+            logger.debug("capture region: %s",
+                         "full frame" if region is None else region)
+        self.region = region
+
+    def find_region(self, transformation, reference_shape, margin):
+        """Find the bounding box of the reference in the full frame.
+
+        Parameters
+        ----------
+        transformation: ndarray
+            (3, 3) transformation from the reference to the full frame.
+        reference_shape: tuple of int
+            (M, N) shape of the reference image.
+        margin: float
+            Margin added around the bounding box, relative to its size.
+
+        Returns
+        -------
+        tuple of int
+            (x, y, width, height) of the region, with margin, or `None` if
+            the reference is outside of the frame.
+        """
+        height, width = reference_shape
+        corners = np.float32([[0, 0], [width, 0], [width, height],
+                              [0, height]])
+        warped = cv2.perspectiveTransform(corners[None], transformation)[0]
+        x_min, y_min = warped.min(axis=0)
+        x_max, y_max = warped.max(axis=0)
+        margin_x = margin * (x_max - x_min)
+        margin_y = margin * (y_max - y_min)
+        frame_height, frame_width = self.frame_shape
+        x_min = int(max(np.floor(x_min - margin_x), 0))
+        y_min = int(max(np.floor(y_min - margin_y), 0))
+        x_max = int(min(np.ceil(x_max + margin_x), frame_width))
+        y_max = int(min(np.ceil(y_max + margin_y), frame_height))
+        if x_max <= x_min or y_max <= y_min:
+            return None
+        return (x_min, y_min, x_max - x_min, y_max - y_min)
+
+    def capture(self):
+        """Capture an image.
+
+        Returns
+        -------
+        ndarray
+            The captured grayscale image, restricted to the region of
+            interest if any.
+        """
+        if self.use_test_image:
+            image = self.test_image
+            if self.region is not None:
+                x, y, width, height = self.region
+                image = image[y:y + height, x:x + width]
+            return image
+        self.grab(self.capture_path)
+        image = scanner.read_image_grayscale(self.capture_path)
+        if image is None:
+            raise RuntimeError(
+                "cannot read image '{:s}'".format(self.capture_path))
+        return image
+
+    def roi_arguments(self):
+        """Arguments of raspistill to capture the region of interest."""
+        frame_height, frame_width = self.frame_shape
+        if self.region is None:
+            return ['--width', str(frame_width), '--height', str(frame_height)]
+        x, y, width, height = self.region
+        # The sensor region is set before the flips are applied.
+        if self.horizontal_flip:
+            x = frame_width - x - width
+        if self.vertical_flip:
+            y = frame_height - y - height
+        roi = [x / float(frame_width), y / float(frame_height),
+               width / float(frame_width), height / float(frame_height)]
+        return ['--roi', ",".join("{:.4f}".format(value) for value in roi),
+                '--width', str(int(round(width * self.roi_scale))),
+                '--height', str(int(round(height * self.roi_scale)))]
+
+    def grab(self, image_path):
+        """Grab an image with the camera.
+
+        Parameters
+        ----------
+        image_path: string
+            File path where to store the image.
+
+        Raises
+        ------
+        RuntimeError if the subprocess call fails.
+        """
+        tmp_image_path = '/tmp/fablab_schedule_image.tmp'
+        args = ['/opt/vc/bin/raspistill',
+                '--output', tmp_image_path,
+                '--encoding', 'png',
+                '--timeout', '1',
+                '--exposure', 'auto',
+                ]
+        args += self.roi_arguments()
+        if self.vertical_flip:
+            args += ['--vflip']
+        if self.horizontal_flip:
+            args += ['--hflip']
+        try:
+            subprocess.check_output(args, stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError as e:
+            raise RuntimeError(e.output.decode("utf-8"))
+        os.rename(tmp_image_path, image_path)
+
+        return True
 
 
 def get_reference_image_path():
@@ -96,13 +295,95 @@ def get_test_image_path():
     return resource_filename("fablab_schedule", "data/wall-test.jpg")
 
 
-def process(capture_path):
+def make_scanner():
     reference_path = get_reference_image_path()
-    detector = "brisk"
-    schedule, unwarped = scanner.scan(reference_path, capture_path, detector)
+    reference = scanner.read_image_grayscale(reference_path)
+    schedule_scanner = scanner.ScheduleScanner(
+        reference, _config['detector'], _config['n_features'],
+        _config['tiles'], min_quality=_config['min_quality'],
+        race_detector_name=_config['race_detector'])
+    update_table(schedule_scanner)
+    return schedule_scanner
+
+
+def update_table(schedule_scanner):
+    """Rebuild the table blueprint and the slot tracker of the scanner.
+
+    The reference features and the transformation are kept.
+    """
+    table_blueprint = scanner.TableBlueprint.from_config(_config)
+    slot_scanner = scanner.SlotScanner(table_blueprint)
+    schedule_scanner.table_blueprint = table_blueprint
+    schedule_scanner.slot_scanner = scanner.SlotTracker(slot_scanner)
+
+
+def make_frame_source():
+    return FrameSource(_config['vertical_flip'], _config['horizontal_flip'],
+                       _config['use_test_image'], _config['use_roi'],
+                       _config['roi_margin'], _config['roi_scale'])
+
+
+def reload_config(watcher):
+    """Read the configuration again if its files changed.
+
+    Returns
+    -------
+    set of string
+        Names of the changed sections.
+    """
+    if not watcher.poll():
+        return set()
+    try:
+        new_config = watcher.read()
+    except Exception as e:
+        logger.error("cannot reload the configuration: %s", e)
+        return set()
+    sections = config.changed_sections(_config, new_config)
+    _config.update(new_config)
+    if sections:
+        logger.info("configuration reloaded: %s changed",
+                    ", ".join(sorted(sections)))
+    return sections
+
+
+def process(schedule_scanner, image, frame_to_image, adaptive_scheduler):
+    """Scan the captured image, degrading according to the scheduler."""
+
+    if adaptive_scheduler.reduce_features:
+        n_features = schedule_scanner.n_features
+        schedule_scanner.max_keypoints = \
+            int(n_features * adaptive_scheduler.feature_scale)
+    else:
+        schedule_scanner.max_keypoints = None
+
+    reuse = adaptive_scheduler.reuse_transformation()
+    schedule = schedule_scanner.scan(image, reuse_transformation=reuse,
+                                     frame_to_image=frame_to_image)
+    adaptive_scheduler.registered("homography" in schedule_scanner.timings)
+    for stage, cost in schedule_scanner.timings.items():
+        adaptive_scheduler.record(stage, cost)
+
+    debug_output = _config['debug_output']
+    if debug_output is not None and not adaptive_scheduler.skip_debug_output:
+        with timed(adaptive_scheduler, "debug_output"):
+            table_blueprint = schedule_scanner.slot_scanner.table_blueprint
+            highlighted = scanner.highlight_slots(schedule_scanner.unwarped,
+                                                  table_blueprint)
+            cv2.imwrite(debug_output, highlighted)
+
     return schedule
 
 
+@contextlib.contextmanager
+def timed(adaptive_scheduler, stage):
+    """Report the cost of the enclosed block to the scheduler."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        adaptive_scheduler.record(stage, time.perf_counter() - t0)
+
+
 def parse_table(table_string):
     """Parse a table of space-separated boolean values into a 2d list."""
     rows = table_string.split("\n")
@@ -114,11 +395,11 @@ def parse_table(table_string):
     return table
 
 
-def is_open_access():
+def is_open_access(session):
     """Returns true during open access hours."""
     service = api.ScheduleService(_config['base_url'])
     url = service.url_for("status")
-    r = requests.get(url)
+    r = session.get(url)
     if r.status_code != 200:
         raise RuntimeError("cannot get open access status")
     data = r.json()
@@ -128,12 +409,12 @@ def is_open_access():
     return is_open
 
 
-def post_table(table):
+def post_table(session, table):
     service = api.ScheduleService(_config['base_url'])
     url = service.url_for("schedule")
     params = dict(username=_config['username'], password=_config['password'])
     json_data = dict(table=table)
-    r = requests.post(url, params=params, json=json_data)
+    r = session.post(url, params=params, json=json_data)
     if r.status_code != 200:
         raise RuntimeError("cannot post schedule: {:s}".format(r.text))
 
@@ -146,42 +427,98 @@ def generate_random_table(n_machines, n_slots):
     return table
 
 
-def mainloop():
-    iteration_delay_sec = 1.0   # seconds
-    while True:
-        t0 = time.perf_counter()
+def mainloop(watcher=None, profiler=None):
+    schedule_scanner = make_scanner()
+    slot_tracker = schedule_scanner.slot_scanner
+    frame_source = make_frame_source()
+    # Keep the connection to the server alive between the requests.
+    session = requests.Session()
+    adaptive_scheduler = scheduler.AdaptiveScheduler(_config['period'],
+                                                     log=logger)
+    # Post when the schedule changes, and periodically to refresh it.
+    post_pending = False
+    last_post = None
+    terminating = False
+    while profiler is None or not profiler.done:
+        if profiler is not None:
+            profiler.start()
+        adaptive_scheduler.begin_iteration()
         try:
+            sections = set() if watcher is None else reload_config(watcher)
+            if "table" in sections:
+                update_table(schedule_scanner)
+                slot_tracker = schedule_scanner.slot_scanner
+                post_pending = True
+            if "camera" in sections:
+                frame_source = make_frame_source()
+                # The flips invalidate the transformation.
+                schedule_scanner.transformation = None
+            if "api" in sections:
+                session.close()
+                session = requests.Session()
+                post_pending = True
+
             if not _config['force_scan']:
-                if not is_open_access():
+                with timed(adaptive_scheduler, "status"):
+                    open_access = is_open_access(session)
+                if not open_access:
                     logger.debug("open access : false")
-                    time.sleep(1.0)
                     continue
 
             message = "open access: true"
             message += " (forced)" if _config['force_scan'] else ""
             logger.debug(message)
 
-            if _config['use_test_image']:
-                input_file = get_test_image_path()
-            else:
-                input_file = "/tmp/capture.png"
-                grab(input_file)
-
-            schedule_table = process(input_file)
-
-            if not _config['disable_post']:
-                post_table(schedule_table)
+            with timed(adaptive_scheduler, "grab"):
+                image = frame_source.capture()
+
+            schedule_table = process(schedule_scanner, image,
+                                     frame_source.frame_to_image(),
+                                     adaptive_scheduler)
+            frame_source.update_region(schedule_scanner.transformation,
+                                       schedule_scanner.reference.shape)
+            if slot_tracker.changed:
+                logger.info("schedule changed (%d slots evaluated)",
+                            slot_tracker.n_evaluated)
+            post_pending = post_pending or slot_tracker.changed
+            refresh = last_post is None \
+                or time.time() - last_post >= _config['refresh_interval']
+
+            if not _config['disable_post'] and (post_pending or refresh):
+                with timed(adaptive_scheduler, "post"):
+                    post_table(session, schedule_table)
+                post_pending = False
+                last_post = time.time()
         except KeyboardInterrupt:
             logger.info("terminate by keyboard interrupt")
+            terminating = True
             break
+        except scanner.RegistrationError as e:
+            logger.error(str(e))
+            # Look for the wall in the full frame again.
+            frame_source.update_region(None, None)
         except Exception as e:
             logger.error(repr(e), exc_info=True)
             pass
+        except BaseException:
+            # E.g. the SystemExit raised on SIGTERM: exit without waiting.
+            terminating = True
+            raise
+        finally:
+            if profiler is not None:
+                profiler.stop()
+            # Also reached when skipping the scan out of open access hours.
+            if not terminating:
+                time.sleep(adaptive_scheduler.end_iteration())
+
+    if profiler is not None:
+        profiler.dump("daemon")
 
-        t1 = time.perf_counter()
-        elapsed = t1 - t0
-        if elapsed < iteration_delay_sec:
-            time.sleep(iteration_delay_sec - elapsed)
+
+def terminate(signum, frame):
+    """Exit cleanly on SIGTERM, flushing the pending log records."""
+    logger.info("terminate by signal %d", signum)
+    raise SystemExit(0)
 
 
 def run():
@@ -196,18 +533,80 @@ def run():
                         help="use bundled test image instead of video capture")
     parser.add_argument("-p", "--disable-post", action="store_true",
                         help="disable posting the table to the remote peer")
+    parser.add_argument("-d", "--detector",
+                        choices=["brisk", "orb", "sift", "surf"],
+                        default="brisk",
+                        help="select feature detector (default: %(default)s)")
+    parser.add_argument("-f", "--features", type=int, default=1000,
+                        help="number of features to detect "
+                             "(default: %(default)d)")
+    parser.add_argument("-r", "--race",
+                        choices=["brisk", "orb", "sift", "surf"],
+                        help="register concurrently with a second detector "
+                             "and keep the first good result")
+    parser.add_argument("-q", "--min-quality", type=float, default=0.2,
+                        help="minimum quality score of the registration "
+                             "(default: %(default)s)")
+    parser.add_argument("--tiles", type=scanner.parse_tiles,
+                        metavar="ROWSxCOLS",
+                        help="detect the features in parallel over a grid of "
+                             "tiles, e.g. 2x2")
+    parser.add_argument("--period", type=float, default=1.0,
+                        help="nominal scan period in seconds "
+                             "(default: %(default)s)")
+    parser.add_argument("--refresh-interval", type=float, default=60.0,
+                        help="interval in seconds between posts of an "
+                             "unchanged schedule (default: %(default)s)")
+    parser.add_argument("--roi", action="store_true",
+                        help="capture only the region of the wall once "
+                             "registered")
+    parser.add_argument("--roi-margin", type=float, default=0.1,
+                        help="margin around the region of the wall, relative "
+                             "to its size (default: %(default)s)")
+    parser.add_argument("--roi-scale", type=float, default=1.0,
+                        help="resolution of the region relative to the full "
+                             "frame (default: %(default)s)")
+    parser.add_argument("--debug-output",
+                        help="output image with the detected slots "
+                             "highlighted, skipped when running late")
+    parser.add_argument("--profile", type=int, default=0, metavar="N",
+                        help="profile N iterations, dump the results and exit")
+    parser.add_argument("--profile-dir", default="/tmp/fablab_schedule",
+                        help="output directory of the profiling results "
+                             "(default: %(default)s)")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="track memory allocations while profiling")
     args = parser.parse_args()
 
     if args.config:
-        _config = config.from_file(args.config)
+        config_paths = [args.config]
     else:
-        _config = config.get()
+        config_paths = config.get_config_file_paths()
+    watcher = config.ConfigWatcher(config_paths)
+    _config = watcher.read()
 
     _config["force_scan"] = args.force_scan
     _config['use_test_image'] = args.test_image
     _config['disable_post'] = args.disable_post
-
-    mainloop()
+    _config['detector'] = args.detector
+    _config['n_features'] = args.features
+    _config['tiles'] = args.tiles
+    _config['race_detector'] = args.race
+    _config['min_quality'] = args.min_quality
+    _config['period'] = args.period
+    _config['refresh_interval'] = args.refresh_interval
+    _config['use_roi'] = args.roi
+    _config['roi_margin'] = args.roi_margin
+    _config['roi_scale'] = args.roi_scale
+    _config['debug_output'] = args.debug_output
+
+    signal.signal(signal.SIGTERM, terminate)
+
+    profiler = None
+    if args.profile > 0:
+        profiler = profiling.Profiler(args.profile, args.profile_dir,
+                                      args.trace_memory, log=logger)
+    mainloop(watcher, profiler)
 
 
 if __name__ == "__main__":
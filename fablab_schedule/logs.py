@@ -0,0 +1,168 @@
+"""Asynchronous, batched logging for the daemon.
+
+The records are put on a queue by the logging calls and written by a
+background thread, so that the main loop never blocks on the log file. The
+writes are batched and the repeated messages are aggregated to reduce the
+wear of the SD card.
+"""
+
+import logging
+from logging.handlers import QueueHandler, RotatingFileHandler
+import queue
+import threading
+import time
+
+
+class BatchRotatingFileHandler(RotatingFileHandler):
+    """Rotating file handler writing a batch of records at once.
+
+    The batch is formatted into a single string, written with a single call
+    and flushed, and the rollover is checked once per batch.
+    """
+
+    def handle_batch(self, records):
+        records = [record for record in records
+                   if record.levelno >= self.level and self.filter(record)]
+        if not records:
+            return
+        self.acquire()
+        try:
+            text = "".join(self.format(record) + self.terminator
+                           for record in records)
+            if self.stream is None:
+                self.stream = self._open()
+            if self.maxBytes > 0:
+                # The stream is flushed after each batch, so seeking is cheap.
+                self.stream.seek(0, 2)
+                size = self.stream.tell()
+                if size > 0 and size + len(text) >= self.maxBytes:
+                    self.doRollover()
+            self.stream.write(text)
+            self.stream.flush()
+        except Exception:
+            self.handleError(records[-1])
+        finally:
+            self.release()
+
+
+class BatchWriter(threading.Thread):
+    """Background thread writing the queued log records by batches.
+
+    A batch is written when it holds `batch_size` records, when a record of
+    level `flush_level` or above arrives, when `flush_interval` seconds have
+    passed since the last timed write, or when the writer is stopped.
+
+    Consecutive records with the same logger, level and message are written
+    once, followed by a summary of the number of repetitions at the next
+    timed write. A repeated error is thus written once per interval.
+
+    Parameters
+    ----------
+    handlers: sequence of logging.Handler
+        Handlers receiving the records. Handlers implementing `handle_batch`
+        receive the whole batch at once.
+    batch_size: int
+        Maximum number of records held before writing.
+    flush_interval: float
+        Maximum delay in seconds before writing a record.
+    flush_level: int
+        Records at this level or above are written immediately.
+    """
+
+    def __init__(self, handlers, batch_size=100, flush_interval=60.0,
+                 flush_level=logging.ERROR):
+        super(BatchWriter, self).__init__(name="log-writer")
+        self.daemon = True
+        self.handlers = handlers
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.flush_level = flush_level
+        self.queue = queue.Queue()
+        self.queue_handler = QueueHandler(self.queue)
+        self.batch = []
+        self.last_key = None
+        self.last_record = None
+        self.repeats = 0
+        self.last_flush = time.time()
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            timeout = self.last_flush + self.flush_interval - time.time()
+            try:
+                record = self.queue.get(timeout=max(timeout, 0))
+            except queue.Empty:
+                self.flush()
+                continue
+            if record is None:
+                self.flush()
+                stopping = True
+            elif self.add(record):
+                if len(self.batch) >= self.batch_size \
+                        or record.levelno >= self.flush_level:
+                    # Keep counting the repetitions across these flushes.
+                    self.flush(reset_repeats=False)
+
+    def add(self, record):
+        """Add a record to the batch, unless it repeats the previous one.
+
+        Returns
+        -------
+        bool
+            `True` if the record was added, `False` if only counted as a
+            repetition.
+        """
+        key = (record.name, record.levelno, record.getMessage())
+        if key == self.last_key:
+            self.repeats += 1
+            self.last_record = record
+            return False
+        self.add_repeats_summary()
+        self.last_key = key
+        self.last_record = record
+        self.batch.append(record)
+        return True
+
+    def add_repeats_summary(self):
+        if self.repeats == 0:
+            return
+        summary = logging.makeLogRecord(self.last_record.__dict__)
+        summary.msg = "last message repeated %d times"
+        summary.args = (self.repeats,)
+        summary.exc_info = None
+        summary.exc_text = None
+        self.batch.append(summary)
+        self.repeats = 0
+
+    def flush(self, reset_repeats=True):
+        """Write the pending records.
+
+        Parameters
+        ----------
+        reset_repeats: bool
+            Write the summary of the repetitions of the last message, whose
+            next occurrence is then written again. Otherwise, its repetitions
+            keep being counted.
+        """
+        if reset_repeats:
+            self.add_repeats_summary()
+            self.last_key = None
+            self.last_flush = time.time()
+        if not self.batch:
+            return
+        batch, self.batch = self.batch, []
+        for handler in self.handlers:
+            if hasattr(handler, "handle_batch"):
+                handler.handle_batch(batch)
+            else:
+                for record in batch:
+                    handler.handle(record)
+
+    def stop(self):
+        """Write the pending records and terminate the thread."""
+        if not self.is_alive():
+            return
+        self.queue.put(None)
+        self.join()
+        for handler in self.handlers:
+            handler.close()
@@ -0,0 +1,203 @@
+"""Profiling helpers for the scanner command line tool and the daemon."""
+
+import cProfile
+import logging
+import os
+import os.path
+import pstats
+import tracemalloc
+
+
+logger = logging.getLogger(__name__)
+
+
+class Profiler:
+    """Profile a fixed number of iterations of a loop.
+
+    CPU time is captured with cProfile. Optionally, the memory allocations are
+    tracked with tracemalloc and the growth between consecutive iterations is
+    logged.
+
+    Parameters
+    ----------
+    n_iterations: int
+        Number of iterations to profile.
+    output_dir: string
+        Directory where to dump the profiling results.
+    trace_memory: bool
+        Take a tracemalloc snapshot at the end of every iteration.
+    n_frames: int
+        Number of frames stored in the tracemalloc tracebacks.
+    log: logging.Logger, optional
+        Logger receiving the memory growth and the paths of the results.
+        Defaults to the logger of this module.
+    """
+
+    def __init__(self, n_iterations, output_dir=".", trace_memory=False,
+                 n_frames=1, log=None):
+        self.log = logger if log is None else log
+        self.n_iterations = n_iterations
+        self.output_dir = output_dir
+        self.trace_memory = trace_memory
+        self.n_frames = n_frames
+        self.profile = cProfile.Profile()
+        self.iteration = 0
+        self.running = False
+        self.snapshots = []
+
+    @property
+    def done(self):
+        return self.iteration >= self.n_iterations
+
+    def start(self):
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start(self.n_frames)
+        self.running = True
+        self.profile.enable()
+
+    def stop(self):
+        """Stop profiling the current iteration.
+
+        Calling `stop` again before the next `start` has no effect.
+        """
+        self.profile.disable()
+        if not self.running:
+            return
+        self.running = False
+        self.iteration += 1
+        if self.trace_memory:
+            self.take_snapshot()
+
+    def take_snapshot(self):
+        snapshot = tracemalloc.take_snapshot()
+        snapshot = snapshot.filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ])
+        if self.snapshots:
+            self.log_memory_growth(self.snapshots[-1], snapshot)
+        self.snapshots.append(snapshot)
+
+    def log_memory_growth(self, previous, current, limit=5):
+        stats = current.compare_to(previous, "lineno")
+        growth = sum(stat.size_diff for stat in stats)
+        self.log.info("iteration %d: memory growth %+.1f KiB",
+                      self.iteration, growth / 1024)
+        for stat in stats[:limit]:
+            self.log.debug("  %s", stat)
+
+    def run(self, function, *args, **kwargs):
+        """Call `function` under the profiler as one iteration."""
+        self.start()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self.stop()
+
+    def dump(self, prefix="profile"):
+        """Write the results to `output_dir`.
+
+        The following files are written:
+
+        - `<prefix>.pstats`: the cProfile statistics, readable by `pstats`
+          or `snakeviz`;
+        - `<prefix>.collapsed`: the collapsed stacks, readable by
+          `flamegraph.pl` or `speedscope`;
+        - `<prefix>-<i>.tracemalloc`: the tracemalloc snapshots, if any.
+
+        Parameters
+        ----------
+        prefix: string
+            Prefix of the output file names.
+
+        Returns
+        -------
+        list of string
+            The paths of the written files.
+        """
+        if not os.path.isdir(self.output_dir):
+            os.makedirs(self.output_dir)
+        base = os.path.join(self.output_dir, prefix)
+        paths = []
+
+        pstats_path = base + ".pstats"
+        self.profile.dump_stats(pstats_path)
+        paths.append(pstats_path)
+
+        collapsed_path = base + ".collapsed"
+        stats = pstats.Stats(self.profile)
+        with open(collapsed_path, "w") as collapsed_file:
+            for stack, count in collapsed_stacks(stats):
+                collapsed_file.write("{:s} {:d}\n".format(stack, count))
+        paths.append(collapsed_path)
+
+        for index, snapshot in enumerate(self.snapshots):
+            snapshot_path = "{:s}-{:d}.tracemalloc".format(base, index)
+            snapshot.dump(snapshot_path)
+            paths.append(snapshot_path)
+
+        if self.trace_memory:
+            tracemalloc.stop()
+
+        for path in paths:
+            self.log.info("wrote %s", path)
+        return paths
+
+
+def format_function(function):
+    filename, line, name = function
+    return "{:s}:{:d}:{:s}".format(os.path.basename(filename), line, name)
+
+
+def collapsed_stacks(stats, max_depth=64):
+    """Reconstruct collapsed stacks from the cProfile call graph.
+
+    cProfile records the caller-callee edges only, not the full stacks. The
+    stacks are rebuilt by walking down from the root functions and splitting
+    the time of each function across its callers in proportion to the time
+    spent through each edge.
+
+    Parameters
+    ----------
+    stats: pstats.Stats
+    max_depth: int
+        Stacks deeper than this are truncated.
+
+    Returns
+    -------
+    list of (string, int) pairs
+        The semicolon-separated stacks and their self time in microseconds.
+    """
+    callees = {}
+    roots = []
+    for function, (_, _, _, _, callers) in stats.stats.items():
+        if not callers:
+            roots.append(function)
+        for caller, edge in callers.items():
+            callees.setdefault(caller, []).append((function, edge))
+
+    counts = {}
+
+    def walk(function, stack, scale):
+        self_time = stats.stats[function][2]
+        stack = stack + [format_function(function)]
+        key = ";".join(stack)
+        counts[key] = counts.get(key, 0) + self_time * scale
+        if len(stack) >= max_depth:
+            return
+        for callee, edge in callees.get(function, []):
+            if format_function(callee) in stack:
+                # Ignore recursion.
+                continue
+            callee_total_time = stats.stats[callee][3]
+            edge_total_time = edge[3]
+            if callee_total_time <= 0 or edge_total_time <= 0:
+                continue
+            walk(callee, stack, scale * edge_total_time / callee_total_time)
+
+    for root in roots:
+        walk(root, [], 1.0)
+
+    return [(stack, int(round(seconds * 1e6)))
+            for stack, seconds in sorted(counts.items())
+            if seconds * 1e6 >= 0.5]
@@ -1,13 +1,16 @@
 from __future__ import print_function
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import logging
 import sys
+import threading
+import time
 
 import cv2
 import numpy as np
 
-from fablab_schedule import config
+from fablab_schedule import config, profiling
 
 
 logger = logging.getLogger(__name__)
@@ -15,26 +18,99 @@ logger = logging.getLogger(__name__)
 debug = False
 
 
+class RegistrationError(RuntimeError):
+    """Raised when the image cannot be registered with the reference."""
+
+
+class RegistrationQuality:
+    """Quality of the registration of an image with the reference.
+
+    Attributes
+    ----------
+    n_matches: int
+        Number of matching points.
+    n_inliers: int
+        Number of matching points consistent with the transformation.
+    inlier_ratio: float in [0, 1]
+    reprojection_error: float
+        Mean distance in pixels between the transformed reference inliers and
+        their matches.
+    corners_valid: bool
+        Whether the transformed reference corners form a plausible view of the
+        wall, i.e. a convex, non-mirrored quadrilateral of reasonable area.
+    score: float in [0, 1]
+        Overall quality, 0 for an unusable transformation.
+    """
+
+    def __init__(self, n_matches=0, n_inliers=0, reprojection_error=np.inf,
+                 corners_valid=False, inlier_threshold=7,
+                 min_inliers=30):
+        self.n_matches = n_matches
+        self.n_inliers = n_inliers
+        self.inlier_ratio = n_inliers / float(n_matches) if n_matches else 0.
+        self.reprojection_error = reprojection_error
+        self.corners_valid = corners_valid
+        if corners_valid:
+            self.score = self.inlier_ratio \
+                * min(n_inliers / float(min_inliers), 1.) \
+                * max(1. - reprojection_error / inlier_threshold, 0.)
+        else:
+            self.score = 0.
+
+    def __str__(self):
+        return "score {:.2f} ({:d}/{:d} inliers, error {:.2f}px{:s})".format(
+            self.score, self.n_inliers, self.n_matches,
+            self.reprojection_error,
+            "" if self.corners_valid else ", invalid corners")
+
+
 class ScheduleScanner:
     """Scan the wall schedule image for the booked slots."""
 
     def __init__(self, reference_image, detector_name="brisk",
-                 n_features=1000):
+                 n_features=1000, tiles=None, tile_overlap=64, n_workers=4,
+                 table_blueprint=None, min_quality=0.2,
+                 race_detector_name=None, race_quality=0.5):
         self.reference = reference_image
         self.detector_name = detector_name
+        self.n_features = n_features
         self.detector = self.make_detector(detector_name)
         self.matcher = self.make_matcher(detector_name)
-        self.n_features = n_features
+        self.tiles = tiles
+        self.tile_overlap = tile_overlap
+        self.n_workers = n_workers
+        self.tile_detectors = []
+        self.max_keypoints = None
         self.ref_features = None
+        self.transformation = None
+        self.quality = None
+        self.min_quality = min_quality
+        self.racer = None
+        self.race_quality = race_quality
+        self.race_executor = None
+        if race_detector_name is not None:
+            self.racer = ScheduleScanner(reference_image, race_detector_name,
+                                         n_features, tiles, tile_overlap,
+                                         n_workers, table_blueprint,
+                                         min_quality)
+            self.race_executor = ThreadPoolExecutor(max_workers=2)
+        # Serialize the registrations, as an aborted race may still run.
+        self.registration_lock = threading.Lock()
+        self.table_blueprint = table_blueprint
+        self.slot_scanner = None
         self.schedule = None
         self.unwarped = None
+        self.timings = {}
 
-    def make_detector(self, detector_name):
+    def make_detector(self, detector_name, n_features=None):
         """Construct the detector from its name.
 
         Parameters
         ----------
         detector_name: {"brisk", "orb", "sift", "surf"}
+        n_features: int, optional
+            Number of features to retain, if supported by the detector.
+            Defaults to `n_features`.
 
         Returns
         -------
@@ -45,12 +121,14 @@ class ScheduleScanner:
         ValueError
             In case of invalid detector name.
         """
+        if n_features is None:
+            n_features = self.n_features
         if detector_name == "orb":
-            return cv2.ORB_create(nfeatures=self.n_features, nlevels=4,
+            return cv2.ORB_create(nfeatures=n_features, nlevels=4,
                                   scaleFactor=1.3, patchSize=25,
                                   edgeThreshold=25)
         elif detector_name == "sift":
-            return cv2.xfeatures2d.SIFT_create(nfeatures=self.n_features)
+            return cv2.xfeatures2d.SIFT_create(nfeatures=n_features)
         elif detector_name == "surf":
             return cv2.xfeatures2d.SURF_create()
         elif detector_name == "brisk":
@@ -74,22 +152,174 @@ class ScheduleScanner:
         else:
             return cv2.BFMatcher()
 
-    def compute_features(self, image):
+    def compute_features(self, image, max_keypoints=None, abort=None):
         """Compute keypoints and descriptors.
 
         Parameters
         ----------
         image: ndarray
             (M, N)
+        max_keypoints: int, optional
+            Only describe the strongest `max_keypoints` keypoints.
+        abort: threading.Event, optional
+            Skip the description of the keypoints when set after their
+            detection, and the tiles not started yet in tiled mode.
 
         Returns
         -------
         sequence of (keypoint, descriptor) pairs
+            The descriptors are `None` if aborted.
         """
+        if self.tiles is not None:
+            return self.compute_features_tiled(image, max_keypoints, abort)
         mask = None
-        keypoints, descriptors = self.detector.detectAndCompute(image, mask)
+        if max_keypoints is None and abort is None:
+            keypoints, descriptors = self.detector.detectAndCompute(image,
+                                                                    mask)
+        else:
+            keypoints = self.detector.detect(image, mask)
+            if abort is not None and abort.is_set():
+                return [], None
+            if max_keypoints is not None:
+                keypoints = sorted(keypoints, key=lambda kp: kp.response,
+                                   reverse=True)[:max_keypoints]
+            keypoints, descriptors = self.detector.compute(image, keypoints)
+        return keypoints, descriptors
+
+    def make_tiles(self, shape):
+        """Split an image domain into a grid of overlapping tiles.
+
+        Parameters
+        ----------
+        shape: tuple of int
+            (M, N) shape of the image.
+
+        Returns
+        -------
+        list of (tile, core) pairs
+            `tile` is the (r_min, r_max, c_min, c_max) extent of the tile,
+            including the overlap. `core` is the extent of the tile without
+            the overlap. The cores partition the image.
+        """
+        n_tile_rows, n_tile_cols = self.tiles
+        row_edges = np.linspace(0, shape[0], n_tile_rows + 1).astype(int)
+        col_edges = np.linspace(0, shape[1], n_tile_cols + 1).astype(int)
+        overlap = self.tile_overlap
+        tiles = []
+        for r_min, r_max in zip(row_edges[:-1], row_edges[1:]):
+            for c_min, c_max in zip(col_edges[:-1], col_edges[1:]):
+                core = (r_min, r_max, c_min, c_max)
+                tile = (max(r_min - overlap, 0),
+                        min(r_max + overlap, shape[0]),
+                        max(c_min - overlap, 0),
+                        min(c_max + overlap, shape[1]))
+                tiles.append((tile, core))
+        return tiles
+
+    def compute_tile_features(self, detector, image, tile, core, budget,
+                              abort=None):
+        """Compute the features of one tile in global image coordinates.
+
+        Only the keypoints lying in the core of the tile are kept, so that
+        the overlapping margins do not produce duplicates. The strongest
+        `budget` keypoints are kept.
+
+        Parameters
+        ----------
+        detector: object implementing cv2.FeatureDetector
+            Detector dedicated to the tile.
+        image: ndarray
+            (M, N) whole image.
+        tile: tuple of int
+            (r_min, r_max, c_min, c_max) extent of the tile.
+        core: tuple of int
+            (r_min, r_max, c_min, c_max) extent of the tile core.
+        budget: int
+            Maximum number of keypoints kept in the tile.
+        abort: threading.Event, optional
+            Skip the tile when set before it is started.
+
+        Returns
+        -------
+        sequence of (keypoint, descriptor) pairs
+        """
+        if abort is not None and abort.is_set():
+            return [], None
+        r_min, r_max, c_min, c_max = tile
+        # The descriptors computed on a non-contiguous view are wrong.
+        tile_image = np.ascontiguousarray(image[r_min:r_max, c_min:c_max])
+        keypoints, descriptors = detector.detectAndCompute(tile_image, None)
+        if descriptors is None:
+            return [], None
+
+        core_r_min, core_r_max, core_c_min, core_c_max = core
+        points = cv2.KeyPoint_convert(keypoints) + (c_min, r_min)
+        x, y = points[:, 0], points[:, 1]
+        in_core = (x >= core_c_min) & (x < core_c_max) \
+            & (y >= core_r_min) & (y < core_r_max)
+        responses = np.float32([keypoint.response for keypoint in keypoints])
+        selected = np.flatnonzero(in_core)
+        strongest = np.argsort(-responses[selected], kind="stable")
+        selected = selected[strongest[:budget]]
+
+        for index in selected:
+            keypoints[index].pt = tuple(points[index])
+        keypoints = [keypoints[index] for index in selected]
+        descriptors = descriptors[selected]
         return keypoints, descriptors
 
+    def compute_features_tiled(self, image, max_keypoints=None, abort=None):
+        """Compute keypoints and descriptors tile by tile in parallel.
+
+        The keypoint budget `n_features` is split evenly across the tiles, for
+        a homogeneous spatial coverage of the image. The detection is faster
+        but not equivalent to the whole image one: the scale pyramid of each
+        tile differs, and some keypoints near the tile edges are lost. With
+        BRISK on a 2x2 grid, wall.jpg keeps about 300 of its 372 matches.
+
+        Parameters
+        ----------
+        image: ndarray
+            (M, N)
+        max_keypoints: int, optional
+            Overall keypoint budget, if lower than `n_features`.
+        abort: threading.Event, optional
+            Skip the tiles not started yet when set.
+
+        Returns
+        -------
+        sequence of (keypoint, descriptor) pairs
+            The descriptors are `None` if aborted.
+        """
+        tiles = self.make_tiles(image.shape[:2])
+        budget = max(self.n_features // len(tiles), 1)
+        # Detectors are not guaranteed to be thread-safe: use one per tile.
+        while len(self.tile_detectors) < len(tiles):
+            detector = self.make_detector(self.detector_name, budget)
+            self.tile_detectors.append(detector)
+        if max_keypoints is not None:
+            budget = min(budget, max(max_keypoints // len(tiles), 1))
+        # OpenCV releases the GIL during detection.
+        with ThreadPoolExecutor(max_workers=self.n_workers) as executor:
+            futures = [executor.submit(self.compute_tile_features, detector,
+                                       image, tile, core, budget, abort)
+                       for detector, (tile, core)
+                       in zip(self.tile_detectors, tiles)]
+            results = [future.result() for future in futures]
+        if abort is not None and abort.is_set():
+            return [], None
+
+        keypoints = []
+        descriptors = []
+        for tile_keypoints, tile_descriptors in results:
+            if tile_descriptors is None or len(tile_keypoints) == 0:
+                continue
+            keypoints.extend(tile_keypoints)
+            descriptors.append(tile_descriptors)
+        if len(descriptors) == 0:
+            return keypoints, None
+        return keypoints, np.vstack(descriptors)
+
     def filter_dissimilar_matches(self, matches, max_ratio=0.75):
         """Remove weak matches, i.e. with dissimilar descriptors.
 
@@ -169,15 +399,161 @@ class ScheduleScanner:
 
         Returns
         -------
-        ndarray
-            The (3, 3) transformation matrix that maps the feature sets.
+        transformation: ndarray
+            The (3, 3) transformation matrix that maps the feature sets, or
+            `None` if not found.
+        quality: RegistrationQuality
         """
         method = cv2.RANSAC
         inlier_threshold = 7    # only effective with RANSAC
         #  method = cv2.LMEDS
-        transformation, _ = cv2.findHomography(ref_points, points, method,
+        min_points = 4
+        if len(ref_points) < min_points:
+            return None, RegistrationQuality(len(ref_points))
+        transformation, mask = cv2.findHomography(ref_points, points, method,
+                                                  inlier_threshold)
+        if transformation is None:
+            return None, RegistrationQuality(len(ref_points))
+        quality = self.evaluate_transformation(transformation, ref_points,
+                                               points, mask.ravel() > 0,
                                                inlier_threshold)
-        return transformation
+        return transformation, quality
+
+    def evaluate_transformation(self, transformation, ref_points, points,
+                                inliers, inlier_threshold):
+        """Assess the quality of a transformation.
+
+        Parameters
+        ----------
+        transformation: ndarray
+            (3, 3) transformation matrix.
+        ref_points: ndarray
+            (N, 2) array of np.float32
+        points: ndarray
+            (N, 2) array of np.float32
+        inliers: ndarray
+            (N,) boolean mask of the inliers.
+        inlier_threshold: float
+            Maximum reprojection error of an inlier.
+
+        Returns
+        -------
+        RegistrationQuality
+        """
+        n_inliers = int(inliers.sum())
+        if n_inliers > 0:
+            projected = cv2.perspectiveTransform(ref_points[inliers][None],
+                                                 transformation)[0]
+            errors = np.linalg.norm(projected - points[inliers], axis=1)
+            reprojection_error = float(errors.mean())
+        else:
+            reprojection_error = np.inf
+
+        height, width = self.reference.shape[:2]
+        corners = np.float32([[0, 0], [width, 0], [width, height],
+                              [0, height]])
+        warped = cv2.perspectiveTransform(corners[None], transformation)[0]
+        area = cv2.contourArea(warped, oriented=True)
+        reference_area = cv2.contourArea(corners, oriented=True)
+        # Same orientation, i.e. not mirrored, and not degenerate.
+        area_ratio = area / reference_area
+        corners_valid = bool(cv2.isContourConvex(warped)) \
+            and 0.01 < area_ratio < 100
+
+        return RegistrationQuality(len(ref_points), n_inliers,
+                                   reprojection_error, corners_valid,
+                                   inlier_threshold)
+
+    def register(self, image, max_keypoints=None, abort=None, timings=None):
+        """Find the transformation from the reference to `image`.
+
+        Parameters
+        ----------
+        image: ndarray
+            (M, N) image
+        max_keypoints: int, optional
+            Only use the strongest `max_keypoints` keypoints of the image.
+        abort: threading.Event, optional
+            Abandon the registration as soon as possible when set.
+        timings: dict, optional
+            Where to record the duration of each stage. Defaults to
+            `timings`.
+
+        Returns
+        -------
+        transformation: ndarray
+            The (3, 3) transformation, or `None` if not found or aborted.
+        quality: RegistrationQuality
+        """
+        with self.registration_lock:
+            t0 = time.perf_counter()
+            if self.ref_features is None:
+                self.ref_features = self.compute_features(self.reference)
+            features = self.compute_features(image, max_keypoints, abort)
+            t0 = self.record_timing("features", t0, timings)
+            if abort is not None and abort.is_set():
+                return None, RegistrationQuality()
+            if features[1] is None:
+                return None, RegistrationQuality()
+
+            ref_points, points = self.find_matching_points(self.ref_features,
+                                                           features)
+            t0 = self.record_timing("matching", t0, timings)
+            if abort is not None and abort.is_set():
+                return None, RegistrationQuality()
+
+            transformation, quality = self.find_transformation(ref_points,
+                                                               points)
+            self.record_timing("homography", t0, timings)
+            return transformation, quality
+
+    def race(self, image):
+        """Register `image` with two detectors concurrently.
+
+        The first registration of quality at least `race_quality` wins and the
+        other one is asked to stop. Otherwise, the best registration wins. Only
+        the durations of the winner are recorded in `timings`.
+
+        The loser stops at its next check only: after the detection of the
+        keypoints, before each tile in tiled mode, and between the stages. The
+        detection in progress, which is the dominant cost, is completed.
+        Meanwhile, the loser holds its detector: it sits out the next race
+        rather than delaying it, if still busy.
+
+        Returns
+        -------
+        transformation: ndarray
+            The (3, 3) transformation, or `None` if not found.
+        quality: RegistrationQuality
+        """
+        self.racer.max_keypoints = self.max_keypoints
+        abort = threading.Event()
+        racers = [racer for racer in [self, self.racer]
+                  if not racer.registration_lock.locked()]
+        futures = {}
+        for racer in racers or [self, self.racer]:
+            # The aborted registration may still record its durations.
+            timings = {}
+            future = self.race_executor.submit(racer.register, image,
+                                               self.max_keypoints, abort,
+                                               timings)
+            futures[future] = (racer, timings)
+
+        best = (None, RegistrationQuality())
+        winner, timings = self, {}
+        for future in as_completed(futures):
+            transformation, quality = future.result()
+            if transformation is not None \
+                    and quality.score > best[1].score:
+                best = (transformation, quality)
+                winner, timings = futures[future]
+            if best[1].score >= self.race_quality:
+                abort.set()
+                break
+        self.timings.update(timings)
+        logger.debug("registration won by %s: %s", winner.detector_name,
+                     best[1])
+        return best
 
     def unwarp(self, image, transformation):
         """Apply an inverse perspective transformation to `image`.
@@ -199,52 +575,99 @@ class ScheduleScanner:
                                        cv2.WARP_INVERSE_MAP)
         return unwarped
 
-    def scan(self, image):
+    def scan(self, image, reuse_transformation=False, frame_to_image=None):
         """Scan the image for the schedule.
 
+        The duration of each stage is recorded in `timings`. The
+        transformation is stored in `transformation` in the coordinates of
+        the full camera frame, so that it stays valid when the image is a
+        varying region of the frame.
+
         Parameters
         ----------
         image: ndarray
             (M, N) image
+        reuse_transformation: bool
+            Skip the registration and reuse the transformation found by the
+            previous scan, if any.
+        frame_to_image: ndarray, optional
+            (3, 3) transformation from the full camera frame to `image`, when
+            `image` is a cropped or scaled region of the frame. Defaults to
+            the identity.
 
         Returns
         -------
         schedule: array_like, int
             A 2-dimensional table of boolean values indicating the occupancy of
             the schedule. An entry is `True` if booked, `False` otherwise.
-        """
-        if self.ref_features is None:
-            self.ref_features = self.compute_features(self.reference)
-        features = self.compute_features(image)
-
-        ref_points, points = self.find_matching_points(self.ref_features,
-                                                       features)
-        transformation = self.find_transformation(ref_points, points)
 
+        Raises
+        ------
+        RegistrationError
+            If the quality of the registration is below `min_quality`. The
+            previous transformation is kept.
+        """
+        self.timings = {}
+        if frame_to_image is None:
+            frame_to_image = np.eye(3)
+
+        if not reuse_transformation or self.transformation is None:
+            if self.racer is None:
+                transformation, quality = self.register(image,
+                                                        self.max_keypoints)
+            else:
+                transformation, quality = self.race(image)
+            if transformation is None or quality.score < self.min_quality:
+                raise RegistrationError(
+                    "cannot register the image: {}".format(quality))
+            self.transformation = np.linalg.inv(frame_to_image).dot(
+                transformation)
+            self.quality = quality
+
+        t0 = time.perf_counter()
+        transformation = frame_to_image.dot(self.transformation)
         self.unwarped = self.unwarp(image, transformation)
+        t0 = self.record_timing("unwarp", t0)
 
-        slot_scanner = SlotScanner()
-        schedule_array = slot_scanner.find_booked_slots(self.unwarped)
+        if self.slot_scanner is None:
+            self.slot_scanner = SlotScanner(self.table_blueprint)
+        schedule_array = self.slot_scanner.find_booked_slots(self.unwarped)
         self.schedule = schedule_array.tolist()
+        self.record_timing("slots", t0)
 
         return self.schedule
 
+    def record_timing(self, stage, start, timings=None):
+        """Record the duration of a stage started at time `start`.
+
+        The duration is recorded in `timings`, unless another dictionary is
+        given.
+
+        Returns
+        -------
+        float
+            The current time, i.e. the start of the next stage.
+        """
+        now = time.perf_counter()
+        if timings is None:
+            timings = self.timings
+        timings[stage] = now - start
+        return now
+
 
 class SlotScanner:
 
-    def __init__(self):
-        conf = config.get()
-        self.table_blueprint = TableBlueprint.from_config(conf)
+    def __init__(self, table_blueprint=None):
+        if table_blueprint is None:
+            conf = config.get()
+            table_blueprint = TableBlueprint.from_config(conf)
+        self.table_blueprint = table_blueprint
         self.booked_slots = None
 
     def compute_roughness(self, image):
         dx, dy = np.gradient(image)
         return np.mean(np.sqrt(dx**2 + dy**2))
 
-    def is_card_absent(self, slot_image, threshold):
-        # A card is absent if the roughness is low.
-        return self.compute_roughness(slot_image) < threshold
-
     def compute_roughness_threshold(self, mean_intensity):
         """Compute a roughness threshold adjusted to the mean intensity level.
 
@@ -264,6 +687,39 @@ class SlotScanner:
             * (mean_intensity / reference_mean_intensity_level)
         return threshold
 
+    def compute_slots_roughness(self, image, selection=None):
+        """Compute the roughness of the slots.
+
+        Parameters
+        ----------
+        image : ndarray
+            (M, N) unwarped image of the schedule table, as floats.
+        selection : ndarray, optional
+            (n_rows, n_cols) boolean mask of the slots to evaluate. Defaults to
+            all the slots.
+
+        Returns
+        -------
+        roughness : ndarray
+            (n_rows, n_cols) roughness of the slots, NaN for the slots not
+            selected.
+        """
+        table = self.table_blueprint
+        roughness = np.full(table.shape[:2], np.nan)
+        for row_index in range(table.n_rows):
+            for col_index in range(table.n_cols):
+                if selection is not None \
+                        and not selection[row_index, col_index]:
+                    continue
+                r, c = table.slot_offsets[row_index, col_index]
+                r_min = r - table.slot_radius
+                r_max = r + table.slot_radius
+                c_min = c - table.slot_radius
+                c_max = c + table.slot_radius
+                slot = image[r_min:r_max, c_min:c_max]
+                roughness[row_index, col_index] = self.compute_roughness(slot)
+        return roughness
+
     def find_booked_slots(self, image):
         """Find which slots are booked in the reference image of the schedule.
 
@@ -281,20 +737,284 @@ class SlotScanner:
         image_float = image.astype(float)
         mean_intensity = image_float.mean()
         threshold = self.compute_roughness_threshold(mean_intensity)
-        table = self.table_blueprint
-        schedule = np.zeros(table.shape[:2], dtype=bool)
-        for row_index in range(table.n_rows):
-            for col_index in range(table.n_cols):
-                r, c = table.slot_offsets[row_index, col_index]
-                r_min = r - table.slot_radius
-                r_max = r + table.slot_radius
-                c_min = c - table.slot_radius
-                c_max = c + table.slot_radius
-                slot = image_float[r_min:r_max, c_min:c_max]
-                if self.is_card_absent(slot, threshold):
-                    schedule[row_index, col_index] = True
+        roughness = self.compute_slots_roughness(image_float)
+        # A card is absent if the roughness is low.
+        schedule = roughness < threshold
         return schedule
 
+    def slot_indices(self, shape):
+        """Compute the pixel indices of every slot.
+
+        Parameters
+        ----------
+        shape : tuple of int
+            (M, N) shape of the unwarped images.
+
+        Returns
+        -------
+        rows, cols : ndarray
+            (n_rows, n_cols, S) row and column indices of the slots, where S
+            is the slot size.
+
+        Raises
+        ------
+        ValueError
+            If a slot is not entirely inside the image.
+        """
+        table = self.table_blueprint
+        steps = np.arange(-table.slot_radius, table.slot_radius)
+        rows = table.slot_offsets[..., 0, None] + steps
+        cols = table.slot_offsets[..., 1, None] + steps
+        if rows.min() < 0 or rows.max() >= shape[0] \
+                or cols.min() < 0 or cols.max() >= shape[1]:
+            raise ValueError("slots outside of the image of shape {}"
+                             .format(shape))
+        return rows, cols
+
+    def extract_slots(self, images):
+        """Extract the slots of a stack of unwarped images.
+
+        Parameters
+        ----------
+        images : ndarray
+            (T, M, N) stack of unwarped images of the schedule table.
+
+        Returns
+        -------
+        slots : ndarray
+            (T, n_rows, n_cols, S, S) stack of slot images, as floats.
+        """
+        rows, cols = self.slot_indices(images.shape[1:3])
+        slots = images[:, rows[:, :, :, None], cols[:, :, None, :]]
+        return slots.astype(float)
+
+    def classify_slots(self, slots, mean_intensities):
+        """Classify a stack of slot images in one pass.
+
+        Parameters
+        ----------
+        slots : ndarray
+            (T, n_rows, n_cols, S, S) stack of slot images.
+        mean_intensities : array_like
+            (T,) mean intensity of the image of each frame, to which the
+            roughness threshold is adjusted.
+
+        Returns
+        -------
+        schedules : ndarray
+            (T, n_rows, n_cols) boolean tables, `True` where booked.
+        roughness : ndarray
+            (T, n_rows, n_cols) roughness of the slots.
+        """
+        slots = np.asarray(slots, dtype=float)
+        dx, dy = np.gradient(slots, axis=(-2, -1))
+        roughness = np.mean(np.sqrt(dx**2 + dy**2), axis=(-2, -1))
+        mean_intensities = np.asarray(mean_intensities, dtype=float)
+        thresholds = self.compute_roughness_threshold(mean_intensities)
+        # A card is absent if the roughness is low.
+        schedules = roughness < thresholds[:, None, None]
+        return schedules, roughness
+
+    def find_booked_slots_batch(self, images, chunk_size=64):
+        """Find which slots are booked in a stack of unwarped images.
+
+        This is equivalent to calling `find_booked_slots` on every image, but
+        vectorized over the frames and the slots.
+
+        Parameters
+        ----------
+        images : ndarray
+            (T, M, N) stack of unwarped images of the schedule table.
+        chunk_size : int
+            Number of frames processed at once, bounding the memory usage.
+
+        Returns
+        -------
+        schedules : ndarray
+            (T, n_rows, n_cols) boolean tables, `True` where booked.
+        roughness : ndarray
+            (T, n_rows, n_cols) roughness of the slots.
+        """
+        images = np.asarray(images)
+        n_frames = images.shape[0]
+        shape = (n_frames,) + self.table_blueprint.shape[:2]
+        schedules = np.zeros(shape, dtype=bool)
+        roughness = np.zeros(shape)
+        for start in range(0, n_frames, chunk_size):
+            chunk = images[start:start + chunk_size]
+            mean_intensities = chunk.reshape(len(chunk), -1).mean(axis=1)
+            slots = self.extract_slots(chunk)
+            schedules[start:start + chunk_size], \
+                roughness[start:start + chunk_size] = \
+                self.classify_slots(slots, mean_intensities)
+        return schedules, roughness
+
+
+class SlotTracker:
+    """Track the occupancy of the slots over consecutive frames.
+
+    Each slot keeps a rolling history of its roughness relative to the
+    threshold. The occupancy of a slot changes only when the recent history
+    agrees on the new state with enough confidence, which filters out the
+    flickering slots.
+
+    On each frame, only the slots whose decision is uncertain, or whose mean
+    intensity or contrast changed since the last frame, are evaluated again,
+    along with a rolling subset of the other slots so that every slot is
+    checked at least every `recheck_every` frames. The other slots keep their
+    last roughness.
+
+    Parameters
+    ----------
+    slot_scanner : SlotScanner
+    history : int
+        Number of frames in the rolling history.
+    margin : float
+        Relative distance of the roughness to the threshold from which a
+        decision is fully confident.
+    min_confidence : float in [0, 1]
+        Confidence required to change the occupancy of a slot.
+    min_observations : int
+        Number of observations required to change the occupancy of a slot.
+    change_threshold : float
+        Change of the mean intensity or of the standard deviation of a slot,
+        relative to the mean intensity of the image, from which the slot is
+        evaluated again.
+    recheck_every : int
+        Maximum number of frames between two evaluations of a slot.
+    """
+
+    def __init__(self, slot_scanner, history=5, margin=0.25,
+                 min_confidence=0.5, min_observations=2,
+                 change_threshold=0.05, recheck_every=10):
+        self.slot_scanner = slot_scanner
+        self.table_blueprint = slot_scanner.table_blueprint
+        self.history = history
+        self.margin = margin
+        self.min_confidence = min_confidence
+        self.min_observations = min_observations
+        self.change_threshold = change_threshold
+        self.recheck_every = recheck_every
+        shape = self.table_blueprint.shape[:2]
+        self.ratios = np.full((history,) + shape, np.nan)
+        self.frame_index = 0
+        self.recheck_groups = np.arange(np.prod(shape)).reshape(shape) \
+            % recheck_every
+        self.slot_statistics = None
+        self.booked = None
+        self.confidence = np.zeros(shape)
+        self.changed = False
+        self.n_evaluated = 0
+
+    def compute_slot_statistics(self, image):
+        """Compute the mean and standard deviation of every slot.
+
+        The sums over the slots are read from the integral images of the
+        image and of its square.
+
+        Returns
+        -------
+        ndarray
+            (2, n_rows, n_cols) means and standard deviations.
+        """
+        table = self.table_blueprint
+        integral = np.zeros((2, image.shape[0] + 1, image.shape[1] + 1))
+        integral[0, 1:, 1:] = image.cumsum(0).cumsum(1)
+        integral[1, 1:, 1:] = (image ** 2).cumsum(0).cumsum(1)
+        rows = table.slot_offsets[..., 0]
+        cols = table.slot_offsets[..., 1]
+        r_min = np.clip(rows - table.slot_radius, 0, image.shape[0])
+        r_max = np.clip(rows + table.slot_radius, 0, image.shape[0])
+        c_min = np.clip(cols - table.slot_radius, 0, image.shape[1])
+        c_max = np.clip(cols + table.slot_radius, 0, image.shape[1])
+        sums = integral[:, r_max, c_max] - integral[:, r_min, c_max] \
+            - integral[:, r_max, c_min] + integral[:, r_min, c_min]
+        areas = np.maximum((r_max - r_min) * (c_max - c_min), 1)
+        means, squares = sums / areas
+        deviations = np.sqrt(np.maximum(squares - means ** 2, 0))
+        return np.array([means, deviations])
+
+    def select_slots(self, slot_statistics):
+        """Select the slots to evaluate on the current frame.
+
+        Returns
+        -------
+        selection, recheck : ndarray
+            Boolean tables of the slots to evaluate, and of those among them
+            evaluated only because their turn to be checked came.
+        """
+        if self.booked is None:
+            selection = np.ones(self.confidence.shape, dtype=bool)
+            return selection, ~selection
+        difference = np.abs(slot_statistics - self.slot_statistics)
+        changed = np.any(difference > self.change_threshold, axis=0)
+        # The history of a modified slot is obsolete.
+        self.ratios[:, changed] = np.nan
+        uncertain = self.confidence < self.min_confidence
+        turn = self.recheck_groups == self.frame_index % self.recheck_every
+        return changed | uncertain | turn, turn & ~(changed | uncertain)
+
+    def find_booked_slots(self, image):
+        """Update the occupancy of the slots with a new frame.
+
+        Parameters
+        ----------
+        image : ndarray
+            (M, N) unwarped image of the schedule table.
+
+        Returns
+        -------
+        schedule : array_like, bool
+            A 2-dimensional table of boolean values indicating the stable
+            occupancy of the schedule. An entry is `True` if booked, `False`
+            otherwise. `changed` tells whether it differs from the previous
+            frame.
+        """
+        image_float = image.astype(float)
+        mean_intensity = image_float.mean()
+        threshold = self.slot_scanner.compute_roughness_threshold(
+            mean_intensity)
+        slot_statistics = self.compute_slot_statistics(image_float) \
+            / max(mean_intensity, 1.)
+
+        selection, recheck = self.select_slots(slot_statistics)
+        self.n_evaluated = int(selection.sum())
+        roughness = self.slot_scanner.compute_slots_roughness(image_float,
+                                                              selection)
+        ratios = roughness / threshold
+        if self.booked is not None:
+            # A checked slot contradicting its state has changed unnoticed.
+            contradicted = recheck & ((ratios < 1) != self.booked)
+            self.ratios[:, contradicted] = np.nan
+        previous = self.ratios[(self.frame_index - 1) % self.history]
+        ratios[~selection] = previous[~selection]
+        self.ratios[self.frame_index % self.history] = ratios
+        self.frame_index += 1
+        self.slot_statistics = slot_statistics
+
+        with np.errstate(all="ignore"):
+            median = np.nanmedian(self.ratios, axis=0)
+        observations = np.sum(~np.isnan(self.ratios), axis=0)
+        measured = median < 1
+        votes = np.where(measured, self.ratios < 1, self.ratios >= 1)
+        agreement = votes.sum(axis=0) / np.maximum(observations, 1)
+        # A null roughness is as far as possible from the threshold.
+        median = np.maximum(median, np.finfo(float).tiny)
+        closeness = np.abs(np.log(median)) / np.log(1 + self.margin)
+        self.confidence = agreement * np.clip(closeness, 0, 1)
+        self.confidence[observations == 0] = 0
+
+        if self.booked is None:
+            self.booked = measured
+            self.changed = True
+        else:
+            flip = (measured != self.booked) \
+                & (self.confidence >= self.min_confidence) \
+                & (observations >= self.min_observations)
+            self.booked = np.where(flip, measured, self.booked)
+            self.changed = bool(flip.any())
+        return self.booked.copy()
+
 
 def cartesian_product(x, y):
     return [[(valx, valy) for valy in y] for valx in x]
@@ -357,6 +1077,41 @@ def read_image_grayscale(filename):
     return cv2.imread(filename, 0)
 
 
+def parse_shape(text, name="shape"):
+    """Parse a shape specification of the form "ROWSxCOLS".
+
+    Parameters
+    ----------
+    text: string
+    name: string
+        Name of the parsed value in the error message.
+
+    Returns
+    -------
+    tuple of int
+        The positive number of rows and columns.
+
+    Raises
+    ------
+    argparse.ArgumentTypeError
+        In case of invalid specification.
+    """
+    try:
+        n_rows, n_cols = [int(value) for value in text.lower().split("x")]
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "invalid {:s}: {:s}".format(name, text))
+    if n_rows < 1 or n_cols < 1:
+        raise argparse.ArgumentTypeError(
+            "invalid {:s}: {:s}".format(name, text))
+    return n_rows, n_cols
+
+
+def parse_tiles(text):
+    """Parse a tile grid specification of the form "ROWSxCOLS"."""
+    return parse_shape(text, "tile grid")
+
+
 def parse_arguments():
     """Parse the command line arguments.
 
@@ -378,20 +1133,54 @@ def parse_arguments():
     parser.add_argument("-f", "--features", type=int, default=5000,
                         help="number of features to detect "
                              "(default: %(default)d)")
+    parser.add_argument("-r", "--race",
+                        choices=["brisk", "orb", "sift", "surf"],
+                        help="register concurrently with a second detector "
+                             "and keep the first good result")
+    parser.add_argument("-q", "--min-quality", type=float, default=0.2,
+                        help="minimum quality score of the registration "
+                             "(default: %(default)s)")
+    parser.add_argument("--tiles", type=parse_tiles, metavar="ROWSxCOLS",
+                        help="detect the features in parallel over a grid of "
+                             "tiles, e.g. 2x2")
+    parser.add_argument("--tile-overlap", type=int, default=64,
+                        help="overlap between the tiles in pixels "
+                             "(default: %(default)d)")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="number of detection threads "
+                             "(default: %(default)d)")
     parser.add_argument("-o", "--output",
                         help="output image with detected slots highlighted")
+    parser.add_argument("--profile", type=int, default=0, metavar="N",
+                        help="profile N scans and dump the results")
+    parser.add_argument("--profile-dir", default=".",
+                        help="output directory of the profiling results "
+                             "(default: %(default)s)")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="track memory allocations while profiling")
     parser.add_argument("reference", help="reference image")
     parser.add_argument("input", help="input image")
 
     args = parser.parse_args()
     if args.verbose:
         debug = True
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
     params = dict(
         detector=args.detector,
         n_features=args.features,
+        tiles=args.tiles,
+        tile_overlap=args.tile_overlap,
+        n_workers=args.workers,
+        race_detector=args.race,
+        min_quality=args.min_quality,
         reference_file=args.reference,
         input_file=args.input,
         output_file=args.output,
+        profile=args.profile,
+        profile_dir=args.profile_dir,
+        trace_memory=args.trace_memory,
     )
 
     return params
@@ -408,7 +1197,8 @@ def print_schedule(schedule):
     print(table_string)
 
 
-def scan(reference_file, input_file, detector, n_features=1000):
+def scan(reference_file, input_file, detector, n_features=1000, tiles=None,
+         tile_overlap=64, n_workers=4, race_detector=None, min_quality=0.2):
     reference = read_image_grayscale(reference_file)
     image = read_image_grayscale(input_file)
 
@@ -419,8 +1209,16 @@ def scan(reference_file, input_file, detector, n_features=1000):
         logger.error("cannot read image '{:s}'".format(input_file))
         sys.exit(1)
 
-    scanner = ScheduleScanner(reference, detector, n_features)
-    schedule = scanner.scan(image)
+    scanner = ScheduleScanner(reference, detector, n_features, tiles,
+                              tile_overlap, n_workers,
+                              min_quality=min_quality,
+                              race_detector_name=race_detector)
+    try:
+        schedule = scanner.scan(image)
+    except RegistrationError as e:
+        logger.error(str(e))
+        sys.exit(1)
+    logger.info("registration %s", scanner.quality)
 
     return schedule, scanner.unwarped
 
@@ -432,8 +1230,24 @@ def main():
     input_file = params['input_file']
     detector = params['detector']
     n_features = params['n_features']
-    schedule, unwarped = scan(reference_file, input_file, detector, n_features)
-    print_schedule(schedule)
+    options = dict(tiles=params['tiles'],
+                   tile_overlap=params['tile_overlap'],
+                   n_workers=params['n_workers'],
+                   race_detector=params['race_detector'],
+                   min_quality=params['min_quality'])
+    if params['profile'] > 0:
+        profiler = profiling.Profiler(params['profile'],
+                                      params['profile_dir'],
+                                      params['trace_memory'])
+        while not profiler.done:
+            schedule, unwarped = profiler.run(scan, reference_file,
+                                              input_file, detector,
+                                              n_features, **options)
+        profiler.dump("scan")
+    else:
+        schedule, unwarped = scan(reference_file, input_file, detector,
+                                  n_features, **options)
+    print_schedule(np.array(schedule))
     if params['output_file'] is not None:
         table_blueprint = TableBlueprint.from_config(config.get())
         highlighted = highlight_slots(unwarped, table_blueprint)
@@ -0,0 +1,174 @@
+"""Deadline-aware scheduling of the daemon iterations."""
+
+import logging
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+NOMINAL = 0
+SKIP_DEBUG_OUTPUT = 1
+REDUCE_FEATURES = 2
+REUSE_TRANSFORMATION = 3
+LOWER_FREQUENCY = 4
+
+level_names = {
+    NOMINAL: "nominal",
+    SKIP_DEBUG_OUTPUT: "skip debug output",
+    REDUCE_FEATURES: "reduce features",
+    REUSE_TRANSFORMATION: "reuse transformation",
+    LOWER_FREQUENCY: "lower frequency",
+}
+
+
+class AdaptiveScheduler:
+    """Schedule the iterations of the main loop against a deadline.
+
+    Each iteration has a time budget, a fraction of the iteration period.
+    The stages of an iteration report their cost. When the budget is
+    exceeded for several consecutive iterations, the degradation level is
+    raised, each level implying the previous ones:
+
+    1. skip the optional debug output;
+    2. reduce the number of features used for the registration;
+    3. reuse the last transformation, re-registering only occasionally;
+    4. lower the scan frequency.
+
+    When the iterations complete well within the budget for several
+    consecutive iterations, the degradation level is lowered again.
+
+    Parameters
+    ----------
+    period: float
+        Nominal iteration period in seconds.
+    budget: float in [0, 1]
+        Fraction of the period available for an iteration.
+    degrade_after: int
+        Number of consecutive overruns before degrading.
+    recover_after: int
+        Number of consecutive iterations with headroom before recovering.
+    headroom: float in [0, 1]
+        An iteration has headroom if it uses less than this fraction of the
+        budget.
+    feature_scale: float in [0, 1]
+        Fraction of the features kept when reducing the features.
+    reregister_every: int
+        Number of iterations after which the transformation is recomputed
+        even when reusing it.
+    slow_period_factor: float
+        Factor applied to the period when lowering the frequency.
+    log: logging.Logger, optional
+        Logger receiving the changes of the degradation level. Defaults to
+        the logger of this module.
+    """
+
+    def __init__(self, period=1.0, budget=0.8, degrade_after=2,
+                 recover_after=10, headroom=0.5, feature_scale=0.5,
+                 reregister_every=10, slow_period_factor=4.0, log=None):
+        self.log = logger if log is None else log
+        self.period = period
+        self.budget = budget
+        self.degrade_after = degrade_after
+        self.recover_after = recover_after
+        self.headroom = headroom
+        self.feature_scale = feature_scale
+        self.reregister_every = reregister_every
+        self.slow_period_factor = slow_period_factor
+        self.level = NOMINAL
+        self.overruns = 0
+        self.underruns = 0
+        self.iterations_since_registration = 0
+        self.start = None
+        self.elapsed = 0.
+        self.costs = {}
+
+    @property
+    def deadline(self):
+        return self.period * self.budget
+
+    @property
+    def current_period(self):
+        if self.level >= LOWER_FREQUENCY:
+            return self.period * self.slow_period_factor
+        return self.period
+
+    @property
+    def skip_debug_output(self):
+        return self.level >= SKIP_DEBUG_OUTPUT
+
+    @property
+    def reduce_features(self):
+        return self.level >= REDUCE_FEATURES
+
+    def reuse_transformation(self):
+        """Whether to skip the registration in the current iteration.
+
+        The transformation is reused when degraded, or when the deadline is
+        already exceeded at this point of the iteration, but never for more
+        than `reregister_every` iterations in a row.
+        """
+        if self.iterations_since_registration >= self.reregister_every:
+            return False
+        return self.level >= REUSE_TRANSFORMATION or self.remaining() <= 0
+
+    def registered(self, registered=True):
+        """Report whether the current iteration computed a transformation."""
+        if registered:
+            self.iterations_since_registration = 0
+        else:
+            self.iterations_since_registration += 1
+
+    def begin_iteration(self):
+        self.start = time.perf_counter()
+        self.costs = {}
+
+    def record(self, stage, cost):
+        """Report the cost of a stage in seconds."""
+        self.costs[stage] = self.costs.get(stage, 0.) + cost
+
+    def remaining(self):
+        """Time left before the deadline of the current iteration."""
+        return self.deadline - (time.perf_counter() - self.start)
+
+    def end_iteration(self):
+        """Update the degradation level after an iteration.
+
+        Returns
+        -------
+        float
+            Delay in seconds until the start of the next iteration.
+        """
+        self.elapsed = time.perf_counter() - self.start
+        if self.elapsed > self.deadline:
+            self.overruns += 1
+            self.underruns = 0
+            if self.overruns >= self.degrade_after:
+                self.overruns = 0
+                self.set_level(self.level + 1)
+        elif self.elapsed < self.deadline * self.headroom:
+            self.underruns += 1
+            self.overruns = 0
+            if self.underruns >= self.recover_after:
+                self.underruns = 0
+                self.set_level(self.level - 1)
+        else:
+            self.overruns = 0
+            self.underruns = 0
+        return max(self.current_period - self.elapsed, 0.)
+
+    def set_level(self, level):
+        level = min(max(level, NOMINAL), LOWER_FREQUENCY)
+        if level == self.level:
+            return
+        costs = ", ".join("{:s} {:.3f}s".format(stage, cost)
+                          for stage, cost in self.costs.items())
+        if level > self.level:
+            self.log.warning("iteration took %.3fs (deadline %.3fs: %s): "
+                             "degrade to level %d (%s)", self.elapsed,
+                             self.deadline, costs, level, level_names[level])
+        else:
+            self.log.info("iteration took %.3fs (deadline %.3fs): "
+                          "recover to level %d (%s)", self.elapsed,
+                          self.deadline, level, level_names[level])
+        self.level = level
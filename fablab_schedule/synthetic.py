@@ -0,0 +1,423 @@
+"""Generate synthetic wall schedule images with known ground truth.
+
+The walls are rendered from the reference image: its table area is painted
+with a grid of slots, holding a card or not, then the result is seen under a
+random perspective, lighting and noise. The table size and the resolution
+are arbitrary, for measuring how the scanner scales and whether its accuracy
+holds.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import logging
+import os
+import os.path
+import time
+
+import cv2
+import numpy as np
+
+from fablab_schedule import config, scanner
+
+
+logger = logging.getLogger(__name__)
+
+
+class SyntheticWall:
+    """A synthetic wall image and its ground truth.
+
+    Attributes
+    ----------
+    image: ndarray
+        (M, N) image of the wall, as seen by the camera.
+    booked: ndarray
+        (n_rows, n_cols) boolean table, `True` where the card is absent.
+    transformation: ndarray
+        (3, 3) matrix mapping the reference onto `image`.
+    table: ndarray
+        Unwarped image of the table, i.e. before perspective, lighting and
+        noise.
+    """
+
+    def __init__(self, image, booked, transformation, table):
+        self.image = image
+        self.booked = booked
+        self.transformation = transformation
+        self.table = table
+
+
+def find_table_area(reference, max_intensity=20):
+    """Find the masked table area of the reference image.
+
+    Parameters
+    ----------
+    reference: ndarray
+        (M, N) reference image, whose table area is black.
+    max_intensity: int
+        Pixels darker than this are considered masked.
+
+    Returns
+    -------
+    tuple of int
+        (r_min, r_max, c_min, c_max) extent of the table area.
+    """
+    mask = (reference < max_intensity).astype(np.uint8)
+    _, _, stats, _ = cv2.connectedComponentsWithStats(mask)
+    # Component 0 is the unmasked background.
+    largest = 1 + np.argmax(stats[1:, cv2.CC_STAT_AREA])
+    c_min, r_min, width, height = stats[largest, :4]
+    return r_min, r_min + height, c_min, c_min + width
+
+
+def make_blueprint(table_area, n_rows, n_cols, slot_fill=0.7):
+    """Lay out a regular grid of slots over the table area.
+
+    Parameters
+    ----------
+    table_area: tuple of int
+        (r_min, r_max, c_min, c_max) extent of the table area.
+    n_rows, n_cols: int
+        Size of the table.
+    slot_fill: float in [0, 1]
+        Size of the slots relative to the grid pitch.
+
+    Returns
+    -------
+    TableBlueprint
+    """
+    r_min, r_max, c_min, c_max = table_area
+    row_pitch = (r_max - r_min) / float(n_rows)
+    col_pitch = (c_max - c_min) / float(n_cols)
+    row_offsets = r_min + (np.arange(n_rows) + 0.5) * row_pitch
+    column_offsets = c_min + (np.arange(n_cols) + 0.5) * col_pitch
+    slot_offsets = scanner.TableBlueprint.make_slot_offsets(row_offsets,
+                                                            column_offsets)
+    slot_radius = max(int(slot_fill * min(row_pitch, col_pitch) / 2), 2)
+    return scanner.TableBlueprint(slot_offsets, slot_radius)
+
+
+def scale_blueprint(table_blueprint, scale):
+    """Scale a table blueprint along with the reference image."""
+    slot_offsets = np.round(table_blueprint.slot_offsets * scale)
+    slot_radius = max(int(table_blueprint.slot_radius * scale), 2)
+    return scanner.TableBlueprint(slot_offsets, slot_radius)
+
+
+class WallGenerator:
+    """Render random walls for a table of the given size.
+
+    Parameters
+    ----------
+    reference: ndarray
+        (M, N) reference image, whose table area is black.
+    n_rows, n_cols: int
+        Size of the table, laid out as a regular grid over the table area.
+        Ignored if `table_blueprint` is given.
+    scale: float
+        Scale of the rendered table relative to the reference image.
+    output_shape: tuple of int, optional
+        (M, N) shape of the wall images. Defaults to the shape of the scaled
+        reference.
+    perspective: float
+        Maximum displacement of the table corners, relative to the image size.
+    noise: float
+        Maximum standard deviation of the Gaussian noise.
+    seed: int, optional
+        Seed of the random generator.
+    table_blueprint: TableBlueprint, optional
+        Layout of the table in the coordinates of the reference image, e.g.
+        the configured one. Defaults to a regular grid of `n_rows` by
+        `n_cols` slots.
+    """
+
+    def __init__(self, reference, n_rows=None, n_cols=None, scale=1.0,
+                 output_shape=None, perspective=0.1, noise=2.0, seed=None,
+                 table_blueprint=None):
+        self.rng = np.random.RandomState(seed)
+        height, width = reference.shape[:2]
+        size = (int(round(width * scale)), int(round(height * scale)))
+        self.reference = cv2.resize(reference, size,
+                                    interpolation=cv2.INTER_AREA)
+        self.table_area = find_table_area(self.reference)
+        if table_blueprint is None:
+            if n_rows is None or n_cols is None:
+                raise ValueError("either the size of the table or its "
+                                 "blueprint is required")
+            self.table_blueprint = make_blueprint(self.table_area, n_rows,
+                                                  n_cols)
+        else:
+            self.table_blueprint = scale_blueprint(table_blueprint, scale)
+        if output_shape is None:
+            output_shape = self.reference.shape[:2]
+        self.output_shape = output_shape
+        self.perspective = perspective
+        self.noise = noise
+
+        # The wall is the brightest dominant intensity of the reference.
+        wall_intensity = np.median(reference[reference > 100])
+        r_min, r_max, c_min, c_max = self.table_area
+        self.background = self.reference.copy()
+        self.background[r_min:r_max, c_min:c_max] = wall_intensity
+
+    def render_card(self, image, center):
+        """Draw a card of random shade with a symbol on `image`."""
+        r, c = int(center[0]), int(center[1])
+        radius = int(0.8 * self.table_blueprint.slot_radius)
+        shade = self.rng.randint(40, 200)
+        ink = self.rng.randint(0, max(shade - 30, 1))
+        cv2.rectangle(image, (c - radius, r - radius),
+                      (c + radius, r + radius), int(shade), thickness=-1)
+        symbol_radius = max(radius // 2, 1)
+        thickness = max(radius // 6, 1)
+        if self.rng.randint(2):
+            cv2.rectangle(image, (c - symbol_radius, r - symbol_radius),
+                          (c + symbol_radius, r + symbol_radius), int(ink),
+                          thickness)
+        else:
+            triangle = np.int32([[c, r - symbol_radius],
+                                 [c - symbol_radius, r + symbol_radius],
+                                 [c + symbol_radius, r + symbol_radius]])
+            cv2.polylines(image, [triangle], True, int(ink), thickness)
+
+    def render_table(self, booked):
+        """Render the unwarped table with a card in each free slot."""
+        table = self.background.copy()
+        blueprint = self.table_blueprint
+        for row_index in range(blueprint.n_rows):
+            for col_index in range(blueprint.n_cols):
+                if not booked[row_index, col_index]:
+                    center = blueprint.slot_offsets[row_index, col_index]
+                    self.render_card(table, center)
+        return table
+
+    def random_transformation(self):
+        """Draw a random perspective transformation of the reference."""
+        height, width = self.reference.shape[:2]
+        out_height, out_width = self.output_shape
+        source = np.float32([[0, 0], [width, 0], [width, height],
+                             [0, height]])
+        margin = self.perspective * np.float32([out_width, out_height])
+        target = np.float32([[0, 0], [out_width, 0],
+                             [out_width, out_height], [0, out_height]])
+        # Shrink the target towards its center, then move each corner.
+        inward = np.float32([[1, 1], [-1, 1], [-1, -1], [1, -1]])
+        target += inward * margin
+        target += self.rng.uniform(-1, 1, size=(4, 2)) * margin
+        return cv2.getPerspectiveTransform(source, target)
+
+    def apply_lighting(self, image):
+        """Apply a random gain, a linear illumination gradient and noise."""
+        height, width = image.shape[:2]
+        rows, cols = np.mgrid[0:height, 0:width]
+        gain = self.rng.uniform(0.6, 1.2)
+        slope_r, slope_c = self.rng.uniform(-0.3, 0.3, size=2)
+        lighting = gain * (1 + slope_r * (rows / float(height) - 0.5)
+                           + slope_c * (cols / float(width) - 0.5))
+        noise = self.rng.normal(0, self.rng.uniform(0, self.noise),
+                                size=image.shape)
+        lit = image * lighting + noise
+        return np.clip(lit, 0, 255).astype(np.uint8)
+
+    def generate(self, booking_rate=0.3):
+        """Generate a random wall.
+
+        Parameters
+        ----------
+        booking_rate: float in [0, 1]
+            Probability of a slot to be booked, i.e. its card absent.
+
+        Returns
+        -------
+        SyntheticWall
+        """
+        blueprint = self.table_blueprint
+        booked = self.rng.uniform(size=(blueprint.n_rows, blueprint.n_cols)) \
+            < booking_rate
+        table = self.render_table(booked)
+        transformation = self.random_transformation()
+        out_height, out_width = self.output_shape
+        surrounding = int(self.rng.randint(30, 220))
+        warped = cv2.warpPerspective(table, transformation,
+                                     (out_width, out_height),
+                                     flags=cv2.INTER_LINEAR,
+                                     borderValue=surrounding)
+        image = self.apply_lighting(warped)
+        return SyntheticWall(image, booked, transformation, table)
+
+
+def evaluate(generator, walls, detector, n_features):
+    """Scan the walls and compare the results with the ground truth.
+
+    Parameters
+    ----------
+    generator: WallGenerator
+    walls: sequence of SyntheticWall
+    detector: string
+        Name of the feature detector.
+    n_features: int
+
+    Returns
+    -------
+    dict
+        Accuracy of the full scan and of the slot classification alone,
+        number of failed registrations, mean durations of the scan stages and
+        of the slot classification alone.
+    """
+    schedule_scanner = scanner.ScheduleScanner(
+        generator.reference, detector, n_features,
+        table_blueprint=generator.table_blueprint)
+    slot_scanner = scanner.SlotScanner(generator.table_blueprint)
+
+    scan_accuracies = []
+    slot_accuracies = []
+    timings = {}
+    slot_durations = []
+    n_failures = 0
+    for wall in walls:
+        try:
+            schedule = np.array(schedule_scanner.scan(wall.image))
+        except scanner.RegistrationError as e:
+            logger.warning(str(e))
+            n_failures += 1
+            schedule = np.zeros_like(wall.booked)
+        scan_accuracies.append(np.mean(schedule == wall.booked))
+        for stage, duration in schedule_scanner.timings.items():
+            timings.setdefault(stage, []).append(duration)
+
+        # Isolate the slot classification from the registration errors.
+        t0 = time.perf_counter()
+        schedule = slot_scanner.find_booked_slots(wall.table)
+        slot_durations.append(time.perf_counter() - t0)
+        slot_accuracies.append(np.mean(schedule == wall.booked))
+
+    return dict(
+        scan_accuracy=float(np.mean(scan_accuracies)),
+        slot_accuracy=float(np.mean(slot_accuracies)),
+        registration_failures=n_failures,
+        timings={stage: float(np.mean(durations))
+                 for stage, durations in timings.items()},
+        slot_duration=float(np.mean(slot_durations)),
+    )
+
+
+def write_walls(output_dir, generator, walls):
+    """Write the reference, the walls and the ground truth to `output_dir`.
+
+    The ground truth is written to `truth.json` with the blueprint of the
+    table, and for each wall its file name, table of booked slots and
+    transformation from the reference.
+    """
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    cv2.imwrite(os.path.join(output_dir, "reference.png"),
+                generator.reference)
+    blueprint = generator.table_blueprint
+    truth = dict(
+        slot_offsets=blueprint.slot_offsets.tolist(),
+        slot_size=2 * blueprint.slot_radius,
+        walls=[],
+    )
+    for index, wall in enumerate(walls):
+        filename = "wall-{:03d}.png".format(index)
+        cv2.imwrite(os.path.join(output_dir, filename), wall.image)
+        truth["walls"].append(dict(
+            file=filename,
+            table=wall.booked.tolist(),
+            transformation=wall.transformation.tolist(),
+        ))
+    with open(os.path.join(output_dir, "truth.json"), "w") as truth_file:
+        json.dump(truth, truth_file, indent=1)
+
+
+def parse_table_size(text):
+    """Parse a table size specification of the form "ROWSxCOLS"."""
+    return scanner.parse_shape(text, "table size")
+
+
+def parse_resolution(text):
+    """Parse a resolution specification of the form "HEIGHTxWIDTH"."""
+    return scanner.parse_shape(text, "resolution")
+
+
+def main():
+    description = "Generate synthetic wall schedule images with ground truth"
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("reference", help="reference image")
+    parser.add_argument("-t", "--table", type=parse_table_size, default=(7, 9),
+                        metavar="ROWSxCOLS",
+                        help="size of the table, unless --config-table "
+                             "(default: 7x9)")
+    parser.add_argument("-c", "--config-table", action="store_true",
+                        help="use the table layout of the configuration "
+                             "instead of a regular grid")
+    parser.add_argument("-s", "--scale", type=float, default=1.0,
+                        help="scale of the table relative to the reference "
+                             "(default: %(default)s)")
+    parser.add_argument("-r", "--resolution", type=parse_resolution,
+                        metavar="HEIGHTxWIDTH",
+                        help="resolution of the wall images "
+                             "(default: resolution of the scaled reference)")
+    parser.add_argument("-n", "--count", type=int, default=10,
+                        help="number of walls (default: %(default)d)")
+    parser.add_argument("-b", "--booking-rate", type=float, default=0.3,
+                        help="probability of a slot to be booked "
+                             "(default: %(default)s)")
+    parser.add_argument("--perspective", type=float, default=0.1,
+                        help="maximum displacement of the corners relative to "
+                             "the image size (default: %(default)s)")
+    parser.add_argument("--noise", type=float, default=2.0,
+                        help="maximum standard deviation of the noise "
+                             "(default: %(default)s)")
+    parser.add_argument("--seed", type=int, help="seed of the random walls")
+    parser.add_argument("-o", "--output", help="output directory")
+    parser.add_argument("-e", "--evaluate", action="store_true",
+                        help="scan the walls and report accuracy and timings")
+    parser.add_argument("-d", "--detector",
+                        choices=["brisk", "orb", "sift", "surf"],
+                        default="brisk",
+                        help="feature detector for the evaluation "
+                             "(default: %(default)s)")
+    parser.add_argument("-f", "--features", type=int, default=1000,
+                        help="number of features for the evaluation "
+                             "(default: %(default)d)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    reference = scanner.read_image_grayscale(args.reference)
+    if reference is None:
+        parser.error("cannot read image '{:s}'".format(args.reference))
+
+    table_blueprint = None
+    if args.config_table:
+        table_blueprint = scanner.TableBlueprint.from_config(config.get())
+    n_rows, n_cols = args.table
+    generator = WallGenerator(reference, n_rows, n_cols, args.scale,
+                              args.resolution, args.perspective, args.noise,
+                              args.seed, table_blueprint)
+    walls = [generator.generate(args.booking_rate)
+             for __ in range(args.count)]
+
+    if args.output is not None:
+        write_walls(args.output, generator, walls)
+        logger.info("wrote %d walls to %s", len(walls), args.output)
+
+    if args.evaluate:
+        results = evaluate(generator, walls, args.detector, args.features)
+        blueprint = generator.table_blueprint
+        print("table: {:d}x{:d}, image: {:d}x{:d}".format(
+            blueprint.n_rows, blueprint.n_cols, walls[0].image.shape[0],
+            walls[0].image.shape[1]))
+        print("scan accuracy: {:.4f}".format(results["scan_accuracy"]))
+        print("slot accuracy: {:.4f}".format(results["slot_accuracy"]))
+        print("registration failures: {:d}".format(
+            results["registration_failures"]))
+        for stage, duration in results["timings"].items():
+            print("{:s}: {:.4f}s".format(stage, duration))
+        print("slots alone: {:.4f}s".format(results["slot_duration"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -28,6 +28,7 @@ setup(
         "console_scripts": [
             "fablab_schedule_daemon=fablab_schedule.daemon:run",
             "fablab_schedule_scan=fablab_schedule.scanner:main",
+            "fablab_schedule_synth=fablab_schedule.synthetic:main",
         ]
     }
 )